@@ -7,14 +7,53 @@ Modified by: Rohan Talip
 """
 
 import argparse
+import concurrent.futures
+import copy
+import functools
+import mmap
+import os
 import os.path
-from xml.dom.minidom import Document, parse
 import traceback
-from io import StringIO, SEEK_SET
 import logging
+import xml.parsers.expat
+from xml.sax.saxutils import quoteattr
+from types import MappingProxyType
+
+from lxml import etree
 
 logger = logging.getLogger(__name__)
 
+ANDROID_NS = 'http://schemas.android.com/apk/res/android'
+SVG_NS = 'http://www.w3.org/2000/svg'
+
+# fully qualified attribute names, built once so the hot loops do plain
+# dict lookups instead of rebuilding the '{namespace}name' string per path
+PATH_DATA = f'{{{ANDROID_NS}}}pathData'
+FILL_COLOR = f'{{{ANDROID_NS}}}fillColor'
+STROKE_COLOR = f'{{{ANDROID_NS}}}strokeColor'
+TRANSLATE_X = f'{{{ANDROID_NS}}}translateX'
+TRANSLATE_Y = f'{{{ANDROID_NS}}}translateY'
+VIEWPORT_WIDTH = f'{{{ANDROID_NS}}}viewportWidth'
+VIEWPORT_HEIGHT = f'{{{ANDROID_NS}}}viewportHeight'
+
+# prebuilt svg root carrying the namespace map; each conversion clones it
+# instead of re-creating the same boilerplate element
+SVG_TEMPLATE = etree.Element('svg', nsmap={None: SVG_NS})
+
+# compiled once: collects every fill/stroke color attribute value of a
+# drawable in a single C-level pass
+COLOR_XPATH = etree.XPath(
+    '//path/@android:fillColor | //path/@android:strokeColor',
+    namespaces={'android': ANDROID_NS})
+
+# path attributes which map straight onto an svg attribute of another name
+ATTR_MAP = (
+    (f'{{{ANDROID_NS}}}strokeLineJoin', 'stroke-linejoin'),
+    (f'{{{ANDROID_NS}}}strokeLineCap', 'stroke-linecap'),
+    (f'{{{ANDROID_NS}}}strokeMiterLimit', 'stroke-miterlimit'),
+    (f'{{{ANDROID_NS}}}strokeWidth', 'stroke-width'),
+)
+
 
 def read_colors_xml(filepath_or_stream, orig_color_map: dict = None):
     if orig_color_map is not None:
@@ -23,90 +62,184 @@ def read_colors_xml(filepath_or_stream, orig_color_map: dict = None):
         color_map = {}
 
     if filepath_or_stream:
-        colors_xml = parse(filepath_or_stream)
-        resource_node = colors_xml.getElementsByTagName('resources')[0]
-        for color_node in resource_node.getElementsByTagName('color'):
-            name = color_node.attributes['name'].value
-            value = color_node.firstChild.nodeValue
-            if name in color_map:
-                logger.warning('Color ' + name + ' already exists: ' + color_map[name])
-            color_map[name] = value
+        # a colors file is just name/value pairs, so run expat's C parser
+        # directly with a tiny state machine instead of building a tree
+        current_name = None
+        text_parts = []
+
+        def start_element(tag, attrs):
+            nonlocal current_name
+            if tag == 'color':
+                current_name = attrs.get('name')
+                text_parts.clear()
+
+        def character_data(data):
+            if current_name is not None:
+                text_parts.append(data)
+
+        def end_element(tag):
+            nonlocal current_name
+            if tag == 'color' and current_name is not None:
+                if current_name in color_map:
+                    logger.warning('Color ' + current_name +
+                                   ' already exists: ' + color_map[current_name])
+                color_map[current_name] = ''.join(text_parts)
+                current_name = None
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = start_element
+        parser.CharacterDataHandler = character_data
+        parser.EndElementHandler = end_element
+
+        if hasattr(filepath_or_stream, 'read'):
+            parser.ParseFile(filepath_or_stream)
+        else:
+            with open(filepath_or_stream, 'rb') as colors_file:
+                parser.ParseFile(colors_file)
 
     return color_map
 
 
-def get_color(color_map, value, depth: int = 1):
+# follows every @color/ chain in color_map once and stores the final value,
+# so later lookups are a single dict hit with no recursion
+def flatten_color_map(color_map):
+    prefix = '@color/'
+    flat = {}
+    for name, value in color_map.items():
+        seen = {name}
+        while value.startswith(prefix):
+            target = value[len(prefix):]
+            if target in seen:
+                raise ValueError(f'circular @color reference involving {name!r}')
+            if target not in color_map:
+                break
+            seen.add(target)
+            value = color_map[target]
+        flat[name] = value
+    return flat
+
+
+def get_color(color_map, value):
     prefix = '@color/'
 
+    # by far the most common case: a plain #RRGGBB literal, returned as is
+    if len(value) == 7 and value[0] == '#':
+        return value
+
     if value.startswith('#'):
         if len(value) == 9:
             # This is a hex color value with an alpha channel.
             # VectorDrawable files have the alpha at the start and SVG files
             # have it at the end.
-            return '#' + value[3:9] + value[1:3]
+            return f'#{value[3:9]}{value[1:3]}'
         return value
 
-    if depth >= 3:
-        raise Exception('Depth is >= 3')
-
-    if prefix not in value:
-        raise '@color not found in ' + value
+    if not value.startswith(prefix):
+        raise ValueError(f'@color not found in {value!r}')
 
-    name = value.split(prefix)[1]
+    # color_map has been flattened, so a reference resolves in one lookup
+    name = value[len(prefix):]
     color = color_map.get(name)
     if not color:
         return value
-
-    if prefix in color:
-        return get_color(color_map, color, depth + 1)
     return color
 
 
-# extracts all paths inside vd_container and add them into svg_container
-def convert_paths(vd_container, svg_container, svg_xml, color_map):
-    vd_paths = vd_container.getElementsByTagName('path')
-    for vd_path in vd_paths:
-        # only iterate in the first level
-        if vd_path.parentNode == vd_container:
-            svg_path = svg_xml.createElement('path')
-            svg_path.attributes['d'] = vd_path.attributes[
-                'android:pathData'].value
-
-            if vd_path.hasAttribute('android:fillColor'):
-                svg_path.attributes['fill'] = get_color(color_map,
-                                                        vd_path.attributes['android:fillColor'].value)
-            else:
-                svg_path.attributes['fill'] = 'none'
-
-            if vd_path.hasAttribute('android:strokeLineJoin'):
-                svg_path.attributes['stroke-linejoin'] = vd_path.attributes[
-                    'android:strokeLineJoin'].value
-            if vd_path.hasAttribute('android:strokeLineCap'):
-                svg_path.attributes['stroke-linecap'] = vd_path.attributes[
-                    'android:strokeLineCap'].value
-            if vd_path.hasAttribute('android:strokeMiterLimit'):
-                svg_path.attributes['stroke-miterlimit'] = vd_path.attributes[
-                    'android:strokeMiterLimit'].value
-            if vd_path.hasAttribute('android:strokeWidth'):
-                svg_path.attributes['stroke-width'] = vd_path.attributes[
-                    'android:strokeWidth'].value
-            if vd_path.hasAttribute('android:strokeColor'):
-                svg_path.attributes['stroke'] = get_color(color_map,
-                                                          vd_path.attributes['android:strokeColor'].value)
-
-            svg_container.appendChild(svg_path)
+# builds a memoized color resolver over a finished color_map; drawables
+# repeat the same handful of colors across many paths, so after the first
+# resolution every further lookup is a cache hit
+def make_color_resolver(color_map):
+    @functools.lru_cache(maxsize=None)
+    def resolve(value):
+        return get_color(color_map, value)
+    return resolve
+
+
+# recursively converts the groups and paths below vd_container into
+# svg_container, preserving document order and group nesting
+def convert_children(vd_container, svg_container, resolve,
+                     _sub_element=etree.SubElement):
+    for vd_child in vd_container:
+        if vd_child.tag == 'group':
+            svg_group = _sub_element(svg_container, 'g')
+
+            translate_x = vd_child.get(TRANSLATE_X, 0)
+            translate_y = vd_child.get(TRANSLATE_Y, 0)
+
+            if translate_x or translate_y:
+                svg_group.set('transform',
+                              f'translate({translate_x},{translate_y})')
+
+            convert_children(vd_child, svg_group, resolve)
+
+        elif vd_child.tag == 'path':
+            svg_path = _sub_element(svg_container, 'path')
+            convert_path(vd_child, svg_path, resolve)
+
+
+# computes the svg attributes of a single vector drawable path as a list of
+# (name, value) pairs, shared by the tree and streaming converters; the
+# keyword defaults bind the module constants as locals in the hot loop
+def convert_path_attrs(vd_path, resolve,
+                       _path_data=PATH_DATA, _fill_color=FILL_COLOR,
+                       _stroke_color=STROKE_COLOR, _attr_map=ATTR_MAP):
+    get = vd_path.get
+    attrs = [('d', get(_path_data))]
+
+    fill_color = get(_fill_color)
+    if fill_color is None:
+        attrs.append(('fill', 'none'))
+    elif len(fill_color) == 7 and fill_color[0] == '#':
+        # plain hex literal: nothing to resolve
+        attrs.append(('fill', fill_color))
+    else:
+        attrs.append(('fill', resolve(fill_color)))
+
+    for vd_name, svg_name in _attr_map:
+        value = get(vd_name)
+        if value is not None:
+            attrs.append((svg_name, value))
+
+    stroke_color = get(_stroke_color)
+    if stroke_color is not None:
+        if len(stroke_color) == 7 and stroke_color[0] == '#':
+            attrs.append(('stroke', stroke_color))
+        else:
+            attrs.append(('stroke', resolve(stroke_color)))
+
+    return attrs
+
+
+# translates the attributes of a single vector drawable path onto svg_path
+def convert_path(vd_path, svg_path, resolve):
+    for name, value in convert_path_attrs(vd_path, resolve):
+        svg_path.set(name, value)
+
+
+# files below this size go through a regular buffered read, where the mmap
+# setup would cost more than it saves
+MMAP_THRESHOLD = 64 * 1024
+
+
+# parses a drawable file, memory-mapping large ones so their bytes go to
+# the parser straight from the page cache
+def parse_drawable(vd_file_path):
+    if os.name != 'nt' and os.path.getsize(vd_file_path) >= MMAP_THRESHOLD:
+        try:
+            with open(vd_file_path, 'rb') as vd_file:
+                with mmap.mmap(vd_file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as vd_map:
+                    return etree.parse(vd_map)
+        except (OSError, ValueError):
+            pass
+    return etree.parse(vd_file_path)
 
 
 # define the function which converts a vector drawable to a svg
-def convert_vector_drawable(vd_file_path, color_map_paths: list, viewbox_only, output_dir):
+def convert_vector_drawable(vd_file_path, color_map: dict, viewbox_only, output_dir):
 
     # open vector drawable
-    vd_xml = parse(vd_file_path)
-
-    color_map = {}
-    if color_map_paths:
-        for color_map_path in color_map_paths:
-            color_map = read_colors_xml(color_map_path, color_map)
+    vd_xml = parse_drawable(vd_file_path)
 
     svg_xml = convert_vector_drawable_xml(vd_xml, color_map, viewbox_only)
 
@@ -115,84 +248,112 @@ def convert_vector_drawable(vd_file_path, color_map_paths: list, viewbox_only, o
     if output_dir:
         svg_file_path = os.path.join(output_dir,
                                      os.path.basename(svg_file_path))
-    svg_xml.writexml(open(svg_file_path, 'w'),
-                     indent="",
-                     addindent="  ",
-                     newl='\n')
+    data = etree.tostring(svg_xml, pretty_print=True, encoding='utf-8')
+    with open(svg_file_path, 'wb', buffering=1 << 20) as svg_file:
+        svg_file.write(data)
 
 
-def convert_vector_drawable_stream(input_stream, color_map_stream=None) -> str:
+def convert_vector_drawable_stream_bytes(input_stream, color_map_stream=None) -> bytes:
     """
     Convert Android Drawable XML to SVG with use of the optional color map.
 
     :param input_stream: A binary stream containing Android vector drawable
     :param color_map_stream: An optional color schema to be used for conversion
-    :return A string containing a corresponding representation of the drawable in SVG format
+    :return UTF-8 encoded bytes of a corresponding representation of the drawable in SVG format
     """
-    vd_xml = parse(input_stream)
-
     if color_map_stream:
-        color_map = read_colors_xml(color_map_stream)
+        color_map = flatten_color_map(read_colors_xml(color_map_stream))
     else:
         color_map = {}
 
-    svg_xml = convert_vector_drawable_xml(vd_xml, color_map, False)
-    string_stream = StringIO()
-    svg_xml.writexml(string_stream, indent="", addindent="  ", newl='\n')
+    parts = []
+    stream_convert_vector_drawable(input_stream, parts.append, color_map, False)
+    return ''.join(parts).encode('utf-8')
 
-    string_stream.seek(SEEK_SET)
-    return string_stream.getvalue()
 
+def convert_vector_drawable_stream(input_stream, color_map_stream=None) -> str:
+    """
+    Convert Android Drawable XML to SVG with use of the optional color map.
 
-def convert_vector_drawable_xml(vd_xml: Document, color_map,  viewbox_only):
-    vd_node = vd_xml.getElementsByTagName('vector')[0]
+    Callers that write the result to a socket or file should prefer
+    convert_vector_drawable_stream_bytes and skip the text round-trip.
+
+    :param input_stream: A binary stream containing Android vector drawable
+    :param color_map_stream: An optional color schema to be used for conversion
+    :return A string containing a corresponding representation of the drawable in SVG format
+    """
+    return convert_vector_drawable_stream_bytes(
+        input_stream, color_map_stream).decode('utf-8')
+
+
+# single-pass conversion: parse the drawable with iterparse, emit each svg
+# element as soon as its source element is complete and clear the source
+# tree behind us, so memory stays proportional to tree depth, not file size
+def stream_convert_vector_drawable(source, write, color_map, viewbox_only):
+    resolve = make_color_resolver(color_map)
+    context = etree.iterparse(source, events=('start', 'end'),
+                              tag=('vector', 'group', 'path'))
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag == 'vector':
+                viewport_width = elem.get(VIEWPORT_WIDTH)
+                viewport_height = elem.get(VIEWPORT_HEIGHT)
+                write('<?xml version="1.0" ?>\n')
+                write(f'<svg xmlns="{SVG_NS}"')
+                if not viewbox_only:
+                    write(f' width="{viewport_width}" height="{viewport_height}"')
+                write(f' viewBox="0 0 {viewport_width} {viewport_height}">\n')
+            elif elem.tag == 'group':
+                translate_x = elem.get(TRANSLATE_X, 0)
+                translate_y = elem.get(TRANSLATE_Y, 0)
+                if translate_x or translate_y:
+                    write(f'<g transform="translate({translate_x},{translate_y})">\n')
+                else:
+                    write('<g>\n')
+        elif elem.tag == 'path':
+            # the output shape is trivial, so format the element directly
+            # rather than paying for generic serialization
+            attrs = ''.join(f' {name}={quoteattr(value)}'
+                            for name, value in convert_path_attrs(elem, resolve))
+            write(f'<path{attrs}/>\n')
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        elif elem.tag == 'group':
+            write('</g>\n')
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        else:
+            write('</svg>\n')
+
+
+def convert_vector_drawable_xml(vd_xml: etree._ElementTree, color_map, viewbox_only):
+    vd_node = vd_xml.getroot()
+
+    # resolve the distinct colors of the whole file up front, so the
+    # per-path work is a plain dict lookup; the streaming converter cannot
+    # pre-scan and keeps its memoized resolver instead
+    resolved = {value: get_color(color_map, value)
+                for value in set(COLOR_XPATH(vd_xml))}
+    resolve = resolved.__getitem__
 
     # create svg xml
-    svg_xml = Document()
-    svg_node = svg_xml.createElement('svg')
-    svg_xml.appendChild(svg_node)
+    svg_node = copy.deepcopy(SVG_TEMPLATE)
 
     # setup basic svg info
-    svg_node.attributes['xmlns'] = 'http://www.w3.org/2000/svg'
+    viewport_width = vd_node.get(VIEWPORT_WIDTH)
+    viewport_height = vd_node.get(VIEWPORT_HEIGHT)
     if not viewbox_only:
-        svg_node.attributes['width'] = vd_node.attributes[
-            'android:viewportWidth'].value
-        svg_node.attributes['height'] = vd_node.attributes[
-            'android:viewportHeight'].value
-
-    svg_node.attributes['viewBox'] = '0 0 {} {}'.format(
-        vd_node.attributes['android:viewportWidth'].value,
-        vd_node.attributes['android:viewportHeight'].value)
-
-    # iterate through all groups
-    vd_groups = vd_xml.getElementsByTagName('group')
-    for vd_group in vd_groups:
+        svg_node.set('width', viewport_width)
+        svg_node.set('height', viewport_height)
 
-        # create the group
-        svg_group = svg_xml.createElement('g')
+    svg_node.set('viewBox', f'0 0 {viewport_width} {viewport_height}')
 
-        translate_x = translate_y = 0
+    # walk the tree once, in document order
+    convert_children(vd_node, svg_node, resolve)
 
-        if vd_group.hasAttribute('android:translateX'):
-            translate_x = vd_group.attributes['android:translateX'].value
-
-        if vd_group.hasAttribute('android:translateY'):
-            translate_y = vd_group.attributes['android:translateY'].value
-
-        if translate_x or translate_y:
-            svg_group.attributes['transform'] = 'translate({},{})'.format(
-                translate_x, translate_y)
-
-        # iterate through all paths inside the group
-        convert_paths(vd_group, svg_group, svg_xml, color_map)
-
-        # append the group to the svg node
-        svg_node.appendChild(svg_group)
-
-    # iterate through all svg-level paths
-    convert_paths(vd_node, svg_node, svg_xml, color_map)
-
-    return svg_xml
+    return svg_node
 
 
 def main():
@@ -213,19 +374,30 @@ def main():
     parser.add_argument("xml_files", nargs="+", metavar='xml-file')
     args = parser.parse_args()
 
+    # parse the colors files once up front; every input file shares the
+    # same (read-only) color map
+    color_map = {}
     if args.colors_xml_file:
-        color_map_file_paths = args.colors_xml_file
-    else:
-        color_map_file_paths = []
-
-    for xml_file in args.xml_files:
-        print("Converting", xml_file)
-        try:
-            convert_vector_drawable(xml_file, color_map_file_paths, args.viewbox_only,
-                                    args.output_dir)
-        except Exception:
-            print("Failed to convert", xml_file)
-            traceback.print_exc()
+        for color_map_file_path in args.colors_xml_file:
+            color_map = read_colors_xml(color_map_file_path, color_map)
+    color_map = MappingProxyType(flatten_color_map(color_map))
+
+    # convert in parallel: every file is independent, and libxml2 releases
+    # the GIL while parsing and serializing, so threads overlap the I/O and
+    # parse work without the pickling overhead of a process pool
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = [
+            executor.submit(convert_vector_drawable, xml_file, color_map,
+                            args.viewbox_only, args.output_dir)
+            for xml_file in args.xml_files
+        ]
+        for xml_file, future in zip(args.xml_files, futures):
+            print("Converting", xml_file)
+            try:
+                future.result()
+            except Exception:
+                print("Failed to convert", xml_file)
+                traceback.print_exc()
 
 
 if __name__ == "__main__":
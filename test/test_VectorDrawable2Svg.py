@@ -1,7 +1,12 @@
 
 from unittest import TestCase
 
-from drawable2svg.VectorDrawable2Svg import convert_vector_drawable_stream
+from lxml import etree
+
+from drawable2svg.VectorDrawable2Svg import (convert_vector_drawable_stream,
+                                             convert_vector_drawable_stream_bytes,
+                                             convert_vector_drawable_xml,
+                                             get_color)
 
 
 class VectorDrawable2SvgTestCase(TestCase):
@@ -14,3 +19,29 @@ class VectorDrawable2SvgTestCase(TestCase):
 
         self.assertTrue('<svg' in svg)
         self.assertTrue('</svg>' in svg)
+
+    def test_convert_xml_stream_to_svg_bytes(self):
+
+        with open('data/ic_launcher.xml', 'rb') as icon_xml:
+            with open('data/colors.xml', 'rb') as colors_xml:
+                svg = convert_vector_drawable_stream_bytes(icon_xml, colors_xml)
+
+        self.assertIsInstance(svg, bytes)
+        self.assertTrue(b'<svg' in svg)
+        self.assertTrue(b'</svg>' in svg)
+
+    def test_nested_groups_are_preserved(self):
+
+        svg = convert_vector_drawable_xml(etree.parse('data/nested_groups.xml'),
+                                          {}, False)
+
+        outer_groups = svg.findall('g')
+        self.assertEqual(len(outer_groups), 1)
+        inner_groups = outer_groups[0].findall('g')
+        self.assertEqual(len(inner_groups), 1)
+        self.assertEqual(len(inner_groups[0].findall('path')), 1)
+
+    def test_get_color_rejects_unknown_reference(self):
+
+        with self.assertRaises(ValueError):
+            get_color({}, 'not-a-color')